@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+def write_batch_jsonl(bodies, path):
+    """
+    Write chat completion requests to a Batch API input file
+    
+    Args:
+        bodies (dict): Mapping of custom_id to chat completion request body
+        path (str): Path of the JSONL file to write
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, body in bodies.items():
+            request = {
+                "custom_id": str(custom_id),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": body
+            }
+            f.write(json.dumps(request) + "\n")
+
+def run_batch(client, input_path, poll_interval=30):
+    """
+    Upload a Batch API input file, wait for the batch to finish and collect its results.
+    The input file holds report text, so it is deleted as soon as it is uploaded, and the
+    uploaded input, output and error files are removed from OpenAI storage however the batch ends.
+    
+    Args:
+        client (openai.OpenAI): OpenAI client
+        input_path (str): Path of the JSONL file written by write_batch_jsonl
+        poll_interval (int): Seconds to wait between status checks
+        
+    Returns:
+        dict: Mapping of custom_id to the response message content, or None if that request failed
+    """
+    try:
+        with open(input_path, "rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+    finally:
+        os.remove(input_path)
+    
+    # Remove the uploaded report text from OpenAI storage however the batch ends
+    batch_files = [batch_file.id]
+    try:
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h"
+        )
+        logger.info(f"Created batch {batch.id} from {input_path}")
+        
+        # Poll until the batch reaches a terminal state
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(poll_interval)
+            batch = client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            if counts:
+                logger.info(f"Batch {batch.id} is {batch.status} ({counts.completed}/{counts.total} requests done)")
+            else:
+                logger.info(f"Batch {batch.id} is {batch.status}")
+        batch_files += [batch.output_file_id, batch.error_file_id]
+        
+        if batch.status == "failed":
+            raise RuntimeError(f"Batch {batch.id} failed: {batch.errors}")
+        if batch.status != "completed":
+            # Expired or cancelled batches still return the requests that finished
+            logger.warning(f"Batch {batch.id} ended with status '{batch.status}'. Collecting partial results...")
+        
+        results = {}
+        if batch.output_file_id:
+            content = client.files.content(batch.output_file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                else:
+                    logger.warning(f"Request {record['custom_id']} failed in batch: {record.get('error')}")
+                    results[record["custom_id"]] = None
+        
+        return results
+    finally:
+        for file_id in batch_files:
+            if file_id:
+                try:
+                    client.files.delete(file_id)
+                except Exception as e:
+                    logger.warning(f"Could not delete file {file_id} from OpenAI storage: {str(e)}")
@@ -0,0 +1,37 @@
+import os
+from functools import lru_cache
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+# Keep-alive pool shared by every request made through one client, so TLS handshakes are
+# paid once per connection rather than once per request
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Shared synchronous OpenAI client (Batch API jobs and tests)
+    """
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.Client(http2=True, limits=HTTP_LIMITS)
+    )
+
+def new_async_http_client(timeout=60):
+    """
+    Pooled HTTP/2 client for async requests.
+    Async connection pools are tied to the event loop that opened them, so create one
+    per asyncio.run() and close it with `async with`.
+    """
+    return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=timeout)
+
+def new_async_client():
+    """
+    AsyncOpenAI client on its own pooled HTTP/2 connections; use with `async with`.
+    Retries are left to the caller (see rate_limiter.call_openai).
+    """
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=new_async_http_client(),
+        max_retries=0
+    )
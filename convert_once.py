@@ -0,0 +1,20 @@
+import sys
+import pandas as pd
+
+def convert_to_parquet(excel_file, parquet_file):
+    """
+    Convert an Excel sheet of reports to Parquet so later runs load it without parsing the workbook
+    
+    Args:
+        excel_file (str): Path to the source .xlsx file
+        parquet_file (str): Path of the Parquet file to write
+    """
+    print(f"Reading {excel_file}...")
+    df = pd.read_excel(excel_file, engine='openpyxl')
+    df.to_parquet(parquet_file, index=False)
+    print(f"Wrote {len(df)} rows to {parquet_file}")
+
+if __name__ == "__main__":
+    excel_file = sys.argv[1] if len(sys.argv) > 1 else "radiology_cleaned4.xlsx"
+    parquet_file = sys.argv[2] if len(sys.argv) > 2 else "radiology_reports.parquet"
+    convert_to_parquet(excel_file, parquet_file)
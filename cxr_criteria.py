@@ -0,0 +1,37 @@
+import re
+
+CLASSIFICATION_COLUMN = "normal_0_abnormal_1_others_2"
+
+# Classification rubric, shared by extractor.py and the combined CXR + liver classifier in multi_task_reader.py
+CXR_CRITERIA = """- 0 if you are sure it is normal
+- 1 if you are sure it is abnormal
+- 2 if you are not sure OR if the CXR has a line, catheter, or tube mentioned
+
+Comparison to previous CXR is not sufficient for classification unless it clearly states there are abnormalities or normality.
+err on the side of caution and classify as 2 if you are not sure.
+0 if you are sure it is normal with clear chest, no lines, catheters, or tubes, no masses or infiltrates.
+1 if you are sure it is abnormal with radiographic evidence of pneumonia, fluid overload, cardiomegaly, etc.
+suspicious findings are not enough to classify as 1.
+Disease in other parts of the body are not enough to classify as 1.
+"""
+
+# Wording that decides the classification without the model (see prefilter_classification)
+# A report counts as normal boilerplate only if the whole text is made of these sentences
+_NORMAL_RE = re.compile(r'(?:impression:\s*)?'
+                        r'(?:(?:normal (?:chest )?radiograph|no acute (?:cardiopulmonary )?(?:abnormality|findings?)|'
+                        r'(?:the )?lungs are clear|clear lungs)\.?\s*)+', re.IGNORECASE)
+_LINE_RE = re.compile(r'\b(endotracheal tube|central (venous )?catheter|picc? line|chest tube|ng tube)\b', re.IGNORECASE)
+
+def prefilter_classification(report_text):
+    """
+    Classify reports whose wording settles the answer without calling the API:
+    2 if a line, catheter or tube is mentioned, 0 if the entire report is a fixed normal
+    boilerplate sentence (any other text, e.g. a finding, sends it to the model).
+    Returns None for everything else.
+    """
+    report_text = " ".join(str(report_text).split())
+    if _LINE_RE.search(report_text):
+        return 2
+    if _NORMAL_RE.fullmatch(report_text):
+        return 0
+    return None
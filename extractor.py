@@ -1,9 +1,17 @@
 import os
+import json
+import argparse
+import asyncio
 import pandas as pd
-import time
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
 from dotenv import load_dotenv
-from openai import OpenAI
+from batch_api import write_batch_jsonl, run_batch
+from response_cache import cache, cache_key
+from rate_limiter import RateLimiter, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, call_openai
+from cxr_criteria import CLASSIFICATION_COLUMN, CXR_CRITERIA, prefilter_classification
+from clients import get_client, new_async_client
 
 # Configure logging
 logging.basicConfig(
@@ -20,129 +28,363 @@ logger.addHandler(console)
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+INPUT_FILE = "radiology_reports.parquet"
+OUTPUT_FILE = "radiology_classified.parquet"
+# Optional copy of the results for hand-off
+EXCEL_OUTPUT_FILE = "radiology_classified.xlsx"
+# Number of reports read, classified and written at a time
+CHUNK_SIZE = 1000
 
-def classify_report(report_text):
+# Number of API requests allowed in flight at the same time
+MAX_CONCURRENT_REQUESTS = 20
+# Request file written when classifying through the Batch API
+BATCH_INPUT_FILE = "radiology_batch_input.jsonl"
+# Append-only log of (row index, classification) pairs used to resume interrupted runs
+CHECKPOINT_FILE = "radiology_checkpoint.jsonl"
+
+# Number of reports packed into a single chat completion
+REPORTS_PER_REQUEST = 20
+
+MODEL = "gpt-4o-mini"
+
+# Fixed sampling seed so repeated requests return the same answer
+SEED = 42
+
+# Token ids of "0", "1" and "2"
+CLASSIFICATION_LOGIT_BIAS = {"15": 100, "16": 100, "17": 100}
+
+# Static instructions kept byte-identical across requests so OpenAI can reuse the cached prompt prefix
+SYSTEM_PROMPT = ("You are a senior radiologist who classifies chest X-ray reports. Please classify each chest X-ray report to one of the following categories:\n"
+                 + CXR_CRITERIA
+                 + "\nRespond with ONLY the number (0, 1, or 2) representing your classification.\n"
+                 + 'When given several numbered reports, respond instead with a JSON object of the form {"classifications": [...]} containing one number per report, in the same order as the reports.')
+
+def known_classification(report_text):
+    """
+    Classification available without a new request (prefilter rule or response cache), or None
+    """
+    classification = prefilter_classification(report_text)
+    if classification is None:
+        classification = cache.get(cache_key(MODEL, SYSTEM_PROMPT, report_text))
+    return classification
+
+def build_request_body(report_text):
+    """
+    Build the chat completion request used to classify a single report
+    """
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Report: {report_text}"}
+        ],
+        "temperature": 0,
+        "top_p": 1,
+        "seed": SEED,
+        "max_tokens": 1,
+        # Restrict the single output token to "0", "1" or "2" (same ids in cl100k_base and o200k_base)
+        "logit_bias": CLASSIFICATION_LOGIT_BIAS
+    }
+
+async def classify_report_async(client, report_text, sem, limiter):
     """
     Use OpenAI to classify radiology reports as:
     0 - Normal
     1 - Abnormal
     2 - Uncertain/Has lines, catheters, tubes
+
+    The semaphore bounds how many requests are in flight at once and the
+    rate limiter keeps them within the account's RPM/TPM budget.
+    Returns None if the request fails or the response holds no label
+    (e.g. a refusal or content filter leaves the content empty).
     """
-    prompt = """You are a senior radiologist. Please classify this chest X-ray report to one of the following categories:
-    - 0 if you are sure it is normal
-    - 1 if you are sure it is abnormal
-    - 2 if you are not sure OR if the CXR has a line, catheter, or tube mentioned
+    try:
+        response = await call_openai(client, build_request_body(report_text), sem, limiter)
+        # The logit bias restricts any output to a single "0", "1" or "2" token
+        classification = int(response.choices[0].message.content)
+    except Exception as e:
+        logger.error(f"Error classifying report: {str(e)}")
+        return None
     
-    Comparison to previous CXR is not sufficient for classification unless it clearly states there are abnormalities or normality.
-    err on the side of caution and classify as 2 if you are not sure.
-    0 if you are sure it is normal with clear chest, no lines, catheters, or tubes, no masses or infiltrates.
-    1 if you are sure it is abnormal with radiographic evidence of pneumonia, fluid overload, cardiomegaly, etc.
-    suspicious findings are not enough to classify as 1.
-    Disease in other parts of the body are not enough to classify as 1.
+    cache[cache_key(MODEL, SYSTEM_PROMPT, report_text)] = classification
+    return classification
+
+def build_packed_request_body(report_texts):
+    """
+    Build a single chat completion request that classifies several reports at once
+    """
+    reports = "\n\n".join(f"[{i}] {text}" for i, text in enumerate(report_texts, start=1))
     
-    Respond with ONLY the number (0, 1, or 2) representing your classification.
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Reports:\n\n{reports}"}
+        ],
+        "response_format": {"type": "json_object"},
+        "temperature": 0,
+        "top_p": 1,
+        "seed": SEED,
+        "max_tokens": 20 + 4 * len(report_texts)
+    }
+
+async def classify_packed_reports_async(client, report_texts, sem, limiter):
+    """
+    Classify several reports with a single request so the instructions are sent once per group.
+    Falls back to one request per report if the response does not hold one valid
+    classification per report. API errors are raised to the caller rather than retried
+    one report at a time.
+    """
+    response = await call_openai(client, build_packed_request_body(report_texts), sem, limiter)
     
-    Report: """
+    try:
+        classifications = json.loads(response.choices[0].message.content)["classifications"]
+        valid = (len(classifications) == len(report_texts)
+                 and all(type(c) is int and c in (0, 1, 2) for c in classifications))
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        classifications, valid = str(e), False
     
-    # Retry mechanism for API calls
-    max_retries = 3
-    retry_count = 0
+    if valid:
+        for text, classification in zip(report_texts, classifications):
+            cache[cache_key(MODEL, SYSTEM_PROMPT, text)] = classification
+        return classifications
     
-    while retry_count < max_retries:
-        try:
-            # Add rate limiting to avoid hitting API limits
-            time.sleep(1)  # Increased sleep time to reduce API pressure
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",  # Switch to gpt-3.5-turbo which is more reliable
-                messages=[
-                    {"role": "system", "content": "You are a senior radiologist who classifies chest X-ray reports."},
-                    {"role": "user", "content": prompt + report_text}
-                ],
-                temperature=0.2,  # Slightly increased for more reliable responses
-                max_tokens=10     # Using max_tokens which works with gpt-3.5-turbo
-            )
-            
-            # Extract just the classification number
-            result = response.choices[0].message.content.strip()
-            logger.info(f"Raw API response: '{result}'")
-            
-            # Ensure we get a valid classification (0, 1, or 2)
-            if result in ["0", "1", "2"]:
-                return int(result)
-            # Try to extract a digit if there's more text
-            elif any(digit in result for digit in ["0", "1", "2"]):
-                for digit in ["0", "1", "2"]:
-                    if digit in result:
-                        logger.warning(f"Extracted {digit} from response: '{result}'")
-                        return int(digit)
-                        
-            # If we get here, no valid classification found
-            logger.warning(f"Invalid classification received: '{result}'. Retrying...")
-            retry_count += 1
-                
-        except Exception as e:
-            logger.error(f"Error classifying report (attempt {retry_count+1}/{max_retries}): {str(e)}")
-            retry_count += 1
-            time.sleep(2)  # Wait longer between retries
-    
-    # If we've exhausted all retries, default to 2
-    logger.error("All classification attempts failed. Defaulting to 2.")
-    return 2
+    logger.warning(f"Invalid classifications for {len(report_texts)} reports: {classifications}. "
+                   "Classifying them one by one...")
+    return await asyncio.gather(*[classify_report_async(client, text, sem, limiter) for text in report_texts])
+
+def load_checkpoint(path=CHECKPOINT_FILE):
+    """
+    Read the classifications recorded by earlier runs, as a dict of row index to classification
+    """
+    if not os.path.exists(path):
+        return {}
+    done = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Blank or partially written line from an interrupted run
+            done[record["idx"]] = record["label"]
+    return done
+
+def append_checkpoint(checkpoint, report_ids, classifications):
+    """
+    Append (row index, classification) pairs to an open checkpoint file.
+    Failed reports (None) are skipped so a resumed run sends them again.
+    """
+    for idx, classification in zip(report_ids, classifications):
+        if classification is None:
+            continue
+        checkpoint.write(json.dumps({"idx": int(idx), "label": int(classification)}) + "\n")
+    checkpoint.flush()
+
+async def classify_reports_async(client, report_texts, sem, limiter, report_ids=None, checkpoint=None):
+    """
+    Classify a list of reports concurrently, REPORTS_PER_REQUEST reports per request
+    (a group of one report is sent as a single-token request), returning classifications in input order.
+    The client, semaphore and rate limiter are shared by every call in a run.
+    Reports matched by prefilter_classification or already in the response cache are not sent.
+    If a checkpoint file is given, each group's classifications are appended to it
+    under the matching report_ids as soon as the group finishes.
+    Reports that could not be classified are marked as uncertain (2) after checkpointing,
+    so only model labels are recorded.
+    """
+    classifications = [known_classification(text) for text in report_texts]
+    misses = [i for i, classification in enumerate(classifications) if classification is None]
+    logger.info(f"{len(report_texts) - len(misses)} of {len(report_texts)} reports classified by rule or found in cache")
+    if not misses:
+        return classifications
+    
+    miss_texts = [report_texts[i] for i in misses]
+    groups = [miss_texts[i:i + REPORTS_PER_REQUEST] for i in range(0, len(miss_texts), REPORTS_PER_REQUEST)]
+    group_ids = [misses[i:i + REPORTS_PER_REQUEST] for i in range(0, len(misses), REPORTS_PER_REQUEST)]
+    
+    async def classify_group(group, positions):
+        if len(group) == 1:
+            # A lone report gets the single-token request, which needs no JSON parsing
+            result = [await classify_report_async(client, group[0], sem, limiter)]
+        else:
+            result = await classify_packed_reports_async(client, group, sem, limiter)
+        if checkpoint is not None:
+            append_checkpoint(checkpoint, [report_ids[i] for i in positions], result)
+        return result
+    
+    # Retries are left to call_openai so the whole run backs off together
+    tasks = [classify_group(group, positions) for group, positions in zip(groups, group_ids)]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    miss_classifications = []
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to classify {len(group)} reports: {str(result)}")
+            miss_classifications.extend([None] * len(group))
+        else:
+            miss_classifications.extend(result)
+    
+    for i, classification in zip(misses, miss_classifications):
+        classifications[i] = 2 if classification is None else classification  # Default to uncertain
+    return classifications
+
+def classify_report(report_text):
+    """
+    Classify a single report synchronously (used by test_extractor.py)
+    """
+    async def classify():
+        sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        async with new_async_client() as client:
+            return await classify_reports_async(client, [report_text], sem, limiter)
+    
+    return asyncio.run(classify())[0]
+
+def build_batch_jsonl(reports, path=BATCH_INPUT_FILE):
+    """
+    Write one Batch API request per report, keyed by its dataframe index
+    """
+    write_batch_jsonl({idx: build_request_body(text) for idx, text in reports.items()}, path)
+
+def classify_reports_batch_api(reports):
+    """
+    Classify reports through the OpenAI Batch API, storing the results in the response cache.
+    Reports matched by prefilter_classification or already in the response cache are not submitted.
+    Returns the number of reports left without a classification, which the streaming
+    pass classifies with realtime requests.
+    """
+    cached = {idx: known_classification(text) for idx, text in reports.items()}
+    misses = reports[[cached[idx] is None for idx in reports.index]]
+    logger.info(f"{len(reports) - len(misses)} of {len(reports)} reports classified by rule or found in cache")
+    
+    outputs = {}
+    if len(misses):
+        build_batch_jsonl(misses)
+        logger.info(f"Submitting {len(misses)} reports to the Batch API...")
+        outputs = run_batch(get_client(), BATCH_INPUT_FILE)
+    
+    missing = 0
+    for idx, text in misses.items():
+        result = outputs.get(str(idx))
+        if result in ("0", "1", "2"):
+            cache[cache_key(MODEL, SYSTEM_PROMPT, text)] = int(result)
+        else:
+            missing += 1
+    
+    if missing:
+        logger.warning(f"{missing} reports had no valid classification in the batch output "
+                       "and will be classified with realtime requests")
+    return missing
         
-def main():
+def has_report_text(reports):
+    """
+    Boolean mask of reports that are not missing or blank
+    """
+    return reports.notna() & (reports.astype(str).str.strip() != "")
+
+def submit_batch_job(parquet_file, done):
+    """
+    Classify every pending report in the file with one Batch API job.
+    Returns the number of reports the job did not classify.
+    Only the report (and existing classification) columns are loaded; the results land in the
+    response cache, so the streaming pass in main picks them up without further requests.
+    """
+    columns = ["REPORT"]
+    if CLASSIFICATION_COLUMN in parquet_file.schema_arrow.names:
+        columns.append(CLASSIFICATION_COLUMN)
+    df = parquet_file.read(columns=columns).to_pandas()
+    
+    pending = has_report_text(df["REPORT"]) & ~df.index.isin(list(done.keys()))
+    if CLASSIFICATION_COLUMN in df.columns:
+        pending &= df[CLASSIFICATION_COLUMN].isna()
+    return classify_reports_batch_api(df.loc[pending, "REPORT"])
+
+async def classify_chunk(client, df, sem, limiter, done, checkpoint):
+    """
+    Fill in the classification column of one chunk of reports in place.
+    The chunk's index must be the rows' positions in the whole file, as used by the checkpoint.
+    """
+    # Check if column already exists
+    if CLASSIFICATION_COLUMN in df.columns:
+        df[CLASSIFICATION_COLUMN] = df[CLASSIFICATION_COLUMN].astype("Int8")
+    else:
+        # Create new nullable integer column with every report unclassified
+        df[CLASSIFICATION_COLUMN] = pd.Series(pd.NA, index=df.index, dtype="Int8")
+    
+    # Restore classifications recorded by an interrupted run
+    done_idx = df.index[df.index.isin(list(done.keys())) & df[CLASSIFICATION_COLUMN].isna()]
+    if len(done_idx):
+        df.loc[done_idx, CLASSIFICATION_COLUMN] = pd.array([done[idx] for idx in done_idx], dtype="Int8")
+        logger.info(f"Restored {len(done_idx)} classifications from {CHECKPOINT_FILE}")
+    
+    # Mark empty reports as uncertain
+    unclassified = df[CLASSIFICATION_COLUMN].isna()
+    has_text = has_report_text(df["REPORT"])
+    df.loc[unclassified & ~has_text, CLASSIFICATION_COLUMN] = 2
+    todo_idx = df.index[unclassified & has_text].to_numpy()
+    
+    # Classify the remaining reports concurrently, logging each finished group
+    # so an interrupted run resumes where it stopped
+    texts = df.loc[todo_idx, "REPORT"].to_numpy()
+    results = await classify_reports_async(client, texts, sem, limiter, todo_idx, checkpoint)
+    df.loc[todo_idx, CLASSIFICATION_COLUMN] = pd.array(results, dtype="Int8")
+
+async def classify_file(parquet_file, writer, schema, done, checkpoint):
+    """
+    Classify the file chunk by chunk in a single event loop, so every chunk shares
+    one HTTP client, one concurrency limit and one RPM/TPM budget
+    """
+    total_reports = parquet_file.metadata.num_rows
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    
+    offset = 0
+    async with new_async_client() as client:
+        for batch in parquet_file.iter_batches(batch_size=CHUNK_SIZE):
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(offset, offset + len(df))
+            await classify_chunk(client, df, sem, limiter, done, checkpoint)
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            
+            offset += len(df)
+            logger.info(f"Processed {offset}/{total_reports} reports")
+
+def main(use_batch_api=False, write_excel=False):
     try:
-        # Load the Excel file
-        logger.info("Loading Excel file...")
-        file_path = "radiology_cleaned4.xlsx"
-        df = pd.read_excel(file_path, engine='openpyxl')
+        # Stream the reports (created from the Excel sheet by convert_once.py) in chunks,
+        # so memory use does not grow with the number of reports
+        parquet_file = pq.ParquetFile(INPUT_FILE)
+        total_reports = parquet_file.metadata.num_rows
+        logger.info(f"Total reports: {total_reports}, processing {CHUNK_SIZE} at a time")
         
-        # Check if column already exists
-        if "normal_0_abnormal_1_others_2" in df.columns:
+        # Output schema: the input columns plus the classification column as int8
+        schema = parquet_file.schema_arrow
+        if CLASSIFICATION_COLUMN in schema.names:
             logger.info("Classification column already exists. Continuing with unclassified reports...")
-        else:
-            # Create new column with default value of None
-            df["normal_0_abnormal_1_others_2"] = None
-        
-        # Count total reports to process
-        total_reports = df.shape[0]
-        reports_to_process = df[df["normal_0_abnormal_1_others_2"].isna()].shape[0]
+            schema = schema.remove(schema.get_field_index(CLASSIFICATION_COLUMN))
+        schema = schema.append(pa.field(CLASSIFICATION_COLUMN, pa.int8()))
         
-        logger.info(f"Total reports: {total_reports}, Reports to process: {reports_to_process}")
+        done = load_checkpoint()
+        if use_batch_api:
+            # Offline run: one batch job up front instead of realtime requests
+            submit_batch_job(parquet_file, done)
         
-        # Process each unclassified report
-        count = 0
-        for idx, row in df.iterrows():
-            if pd.isna(df.at[idx, "normal_0_abnormal_1_others_2"]):
-                report_text = row["REPORT"]
-                if pd.isna(report_text) or not report_text.strip():
-                    df.at[idx, "normal_0_abnormal_1_others_2"] = 2  # Mark empty reports as uncertain
-                    continue
-                    
-                # Classify report
-                try:
-                    classification = classify_report(report_text)
-                    df.at[idx, "normal_0_abnormal_1_others_2"] = classification
-                    logger.info(f"Report {idx} classified as {classification}")
-                except Exception as e:
-                    logger.error(f"Failed to classify report {idx}: {str(e)}")
-                    df.at[idx, "normal_0_abnormal_1_others_2"] = 2  # Default to uncertain
-                
-                # Save progress periodically
-                count += 1
-                if count % 5 == 0:  # Save more frequently
-                    logger.info(f"Processed {count}/{reports_to_process} reports. Saving...")
-                    df.to_excel("radiology_classified.xlsx", index=False, engine='openpyxl')
+        with open(CHECKPOINT_FILE, "a", encoding="utf-8") as checkpoint, pq.ParquetWriter(OUTPUT_FILE, schema) as writer:
+            asyncio.run(classify_file(parquet_file, writer, schema, done, checkpoint))
         
-        # Save final result
-        logger.info("Saving final results...")
-        df.to_excel("radiology_classified.xlsx", index=False, engine='openpyxl')
+        # The checkpoint is no longer needed once every chunk is written
+        if write_excel:
+            pd.read_parquet(OUTPUT_FILE).to_excel(EXCEL_OUTPUT_FILE, index=False, engine='openpyxl')
+        os.remove(CHECKPOINT_FILE)
         logger.info("Classification complete!")
         
     except Exception as e:
         logger.error(f"Error in main process: {str(e)}")
         
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Classify chest X-ray reports with OpenAI")
+    parser.add_argument("--batch", action="store_true",
+                        help="Use the OpenAI Batch API (cheaper, results within 24h) instead of realtime requests")
+    parser.add_argument("--excel", action="store_true",
+                        help=f"Also write the results to {EXCEL_OUTPUT_FILE}")
+    args = parser.parse_args()
+    main(use_batch_api=args.batch, write_excel=args.excel)
@@ -1,91 +1,126 @@
+import numpy as np
 import pandas as pd
-import requests
-import re
-import time
+import json
+import asyncio
 import os
+from collections import Counter
+import sys
 from dotenv import load_dotenv
+from batch_api import write_batch_jsonl, run_batch
+from response_cache import cache, cache_key
+from rate_limiter import RateLimiter, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, call_openai
+from clients import get_client, new_async_client
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 
-def classify_liver_metastasis(report):
+MODEL = "gpt-4o-mini"
+
+# Number of API requests allowed in flight at the same time
+MAX_CONCURRENT_REQUESTS = 20
+
+# Kept constant (no interpolation) so every request shares the same cacheable prompt prefix
+SYSTEM_PROMPT = "You are a radiologist specialized in cancer mets detection, classify these radiology reports as 0 if there is no liver metastasis, 1 if there is liver metastasis and 2 if not sure. In explanation give one short sentence on why this is your choice (e.g. The report does not mention liver lesions) and in lesion_count the number of liver lesions you identified, or null if you are not sure"
+
+# Structured output schema, so the response is strict JSON with exactly these fields
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "liver",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "classification": {"type": "integer", "enum": [0, 1, 2]},
+                "explanation": {"type": "string"},
+                "lesion_count": {"type": ["integer", "null"]}
+            },
+            "required": ["classification", "explanation", "lesion_count"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Parts of the request body that are the same for every report
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+_BODY_TEMPLATE = {
+    "model": MODEL,
+    "response_format": RESPONSE_FORMAT,
+    "temperature": 0,
+    "max_tokens": 100
+}
+
+def build_request_body(report):
     """
-    Function to classify reports for liver metastasis using OpenAI API
+    Build the chat completion request body used to classify a single report
     
     Args:
         report (str): The radiology report text
-        api_key (str): OpenAI API key
         
     Returns:
-        dict: Dictionary containing classification, explanation, and lesion count
+        dict: Request body for the chat completions endpoint
     """
-    # Create the system prompt
-    system_prompt = "You are a radiologist specialized in cancer mets detection, classify these radiology reports as 0 if there is no liver metastasis, 1 if there is liver metastasis and 2 if not sure. In column 2 explain why this is your choice (e.g. The report does not mention liver lesions) and in column 3 the number of liver lesions you identified which you can leave blank if you are not sure)"
-    
-    # Prepare the API request body
-    body = {
-        "model": "gpt-4o-mini",
+    # Only the user message changes per call
+    return {
+        **_BODY_TEMPLATE,
         "messages": [
-            {"role": "system", "content": system_prompt},
+            _SYSTEM_MESSAGE,
             {"role": "user", "content": f"Analyze this radiology report: {report}"}
-        ],
-        "temperature": 0,
-        "max_tokens": 200
+        ]
     }
+
+def parse_liver_response(result_text):
+    """
+    Extract classification, explanation, and lesion count from the model response
     
-    # Make the API request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
+    Args:
+        result_text (str): The response message content
+        
+    Returns:
+        dict: Dictionary containing classification, explanation, and lesion count
+    """
+    try:
+        data = json.loads(result_text)
+    except json.JSONDecodeError:
+        # Only happens if the response was cut off by max_tokens
+        return {
+            "classification": "API Error",
+            "explanation": f"Invalid JSON response: {result_text}",
+            "lesion_count": None
+        }
+    
+    return {
+        "classification": data["classification"],
+        "explanation": data["explanation"],
+        "lesion_count": data["lesion_count"]
     }
+
+async def classify_liver_metastasis(client, report, sem, limiter):
+    """
+    Function to classify reports for liver metastasis using OpenAI API.
+    Requests go through rate_limiter.call_openai, so they share the RPM/TPM budget
+    and transient errors (429, timeouts, 5xx) are retried with backoff.
     
-    try:
-        response = requests.post(
-            url="https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=body
-        )
+    Args:
+        client (openai.AsyncOpenAI): Client from clients.new_async_client
+        report (str): The radiology report text
+        sem (asyncio.Semaphore): Bounds the number of requests in flight
+        limiter (RateLimiter): Shared rate limiter for the run
         
-        # Parse the response
-        if response.status_code == 200:
-            content = response.json()
-            result_text = content['choices'][0]['message']['content']
-            
-            # Extract classification, explanation, and lesion count from the response
-            classification = None
-            explanation = None
-            lesion_count = None
-            
-            # Try to extract the classification (0, 1, or 2)
-            class_match = re.search(r'\b[012]\b', result_text)
-            if class_match:
-                classification = int(class_match.group())
-            
-            # Extract explanation (everything after classification until any mention of lesion count)
-            explanation_match = re.search(r'(?<=\b[012]\b).*?(?=(lesion|metastasis|count|number))', result_text, re.DOTALL)
-            if explanation_match:
-                explanation = explanation_match.group().strip()
-            else:
-                # If the regex didn't work, just take everything after the classification
-                explanation = re.sub(r'^\b[012]\b', '', result_text).strip()
-            
-            # Try to extract lesion count
-            count_match = re.search(r'\b(\d+)\b(?=\s+lesion)', result_text)
-            if count_match:
-                lesion_count = int(count_match.group(1))
-            
-            return {
-                "classification": classification,
-                "explanation": explanation,
-                "lesion_count": lesion_count
-            }
-        else:
-            print(f"API request failed with status code: {response.status_code}")
-            return {
-                "classification": "API Error",
-                "explanation": f"API Error: {response.status_code}",
-                "lesion_count": None
-            }
+    Returns:
+        dict: Dictionary containing classification, explanation, and lesion count
+    """
+    # Reuse the stored result if this exact report was classified before
+    key = cache_key(MODEL, SYSTEM_PROMPT, report)
+    if key in cache:
+        return cache[key]
+    
+    try:
+        response = await call_openai(client, build_request_body(report), sem, limiter)
+        result = parse_liver_response(response.choices[0].message.content)
+        if result['classification'] != "API Error":
+            cache[key] = result
+        return result
     except Exception as e:
         print(f"Error during API request: {str(e)}")
         return {
@@ -94,77 +129,172 @@ def classify_liver_metastasis(report):
             "lesion_count": None
         }
 
-def process_liver_metastasis(df, output_file,  batch_size=10):
+def new_result_arrays(total_rows):
+    """
+    Preallocate the classification, explanation and lesion count results for every row.
+    -1 marks a missing classification (API error) or lesion count.
+    """
+    return (
+        np.full(total_rows, -1, dtype=np.int8),
+        [None] * total_rows,
+        np.full(total_rows, -1, dtype=np.int32)
+    )
+
+def store_result(results, i, result):
+    """
+    Write a classification result dict into the result arrays at row position i
+    """
+    cls_arr, expl_arr, cnt_arr = results
+    classification = result['classification']
+    cls_arr[i] = classification if classification in (0, 1, 2) else -1
+    expl_arr[i] = result['explanation']
+    cnt_arr[i] = -1 if result['lesion_count'] is None else result['lesion_count']
+
+def assign_results(dataset, results):
+    """
+    Copy the result arrays into the dataset columns, one assignment per column
+    """
+    cls_arr, expl_arr, cnt_arr = results
+    dataset['liver_met_classification'] = pd.arrays.IntegerArray(cls_arr, mask=cls_arr < 0, copy=True)
+    dataset['liver_met_explanation'] = expl_arr
+    dataset['liver_lesion_count'] = pd.arrays.IntegerArray(cnt_arr, mask=cnt_arr < 0, copy=True)
+
+def empty_report_mask(reports):
+    """
+    Boolean array marking reports with no text, which never reach the API
+    """
+    return (reports.isna() | (reports == "")).to_numpy()
+
+def classify_with_batch_api(dataset, batch_input_file):
     """
-    Main function to process the dataframe for liver metastasis classification
+    Classify every non-empty report in the dataset through the OpenAI Batch API,
+    storing the results in the response cache
     
     Args:
-        df (pandas.DataFrame): DataFrame containing radiology reports
-        output_file (str): Path to the output CSV file
-        api_key (str): OpenAI API key
-        batch_size (int): Number of reports to process in each batch
+        dataset (pandas.DataFrame): DataFrame with a 'report' column
+        batch_input_file (str): Path of the JSONL request file to upload
         
     Returns:
-        pandas.DataFrame: Processed DataFrame with classification results
+        int: Number of reports left without a result, classified later with realtime requests
     """
-    # Check if the report column exists
-    if "report" not in df.columns:
-        raise ValueError("Error: 'report' column not found in the dataframe")
+    reports = dataset['report'].to_numpy()
+    positions = np.flatnonzero(~empty_report_mask(dataset['report']))
     
-    # Create a copy of the dataframe to avoid modifying the original
-    dataset = df.copy()
+    # Only submit reports that are not already in the response cache
+    cached = {i: cache.get(cache_key(MODEL, SYSTEM_PROMPT, reports[i])) for i in positions}
+    misses = [i for i in positions if cached[i] is None]
+    print(f"{len(positions) - len(misses)} of {len(positions)} reports found in cache")
     
-    # Create new columns for classification, explanation, and lesion count
-    dataset['liver_met_classification'] = None
-    dataset['liver_met_explanation'] = None
-    dataset['liver_lesion_count'] = None
+    outputs = {}
+    if misses:
+        write_batch_jsonl({i: build_request_body(reports[i]) for i in misses}, batch_input_file)
+        print(f"Submitting {len(misses)} reports to the Batch API (this can take up to 24 hours)...")
+        outputs = run_batch(get_client(), batch_input_file)
     
-    # Process in batches to avoid rate limiting
-    total_rows = len(dataset)
-    num_batches = (total_rows + batch_size - 1) // batch_size  # Ceiling division
+    missing = 0
+    for i in misses:
+        result_text = outputs.get(str(i))
+        result = None if result_text is None else parse_liver_response(result_text)
+        if result is None or result['classification'] == "API Error":
+            missing += 1
+        else:
+            cache[cache_key(MODEL, SYSTEM_PROMPT, reports[i])] = result
+    
+    if missing:
+        print(f"{missing} reports had no valid result in the batch output and will be classified with realtime requests")
+    return missing
+
+async def classify_chunk(client, dataset, results, sem, limiter):
+    """
+    Classify one chunk of reports concurrently
     
-    print(f"Processing {total_rows} reports in {num_batches} batches...")
+    Args:
+        client (openai.AsyncOpenAI): Client shared by every chunk
+        dataset (pandas.DataFrame): DataFrame with a 'report' column
+        results (tuple): Result arrays from new_result_arrays, filled in place
+        sem (asyncio.Semaphore): Bounds the number of requests in flight
+        limiter (RateLimiter): Shared rate limiter for the run
+    """
+    reports = dataset['report'].to_numpy()
+    empty = empty_report_mask(dataset['report'])
     
-    for batch_num in range(1, num_batches + 1):
-        start_idx = (batch_num - 1) * batch_size
-        end_idx = min(batch_num * batch_size, total_rows)
-        
-        print(f"Processing batch {batch_num} of {num_batches} (rows {start_idx + 1} to {end_idx})...")
-        
-        for i in range(start_idx, end_idx):
-            report_text = dataset.loc[i, 'report']
+    # Skip empty reports
+    to_classify = []
+    for i in range(len(dataset)):
+        if empty[i]:
+            store_result(results, i, {"classification": 2, "explanation": "No report text available", "lesion_count": None})
+        else:
+            to_classify.append(i)
+    
+    chunk_results = await asyncio.gather(*[classify_liver_metastasis(client, reports[i], sem, limiter) for i in to_classify])
+    for i, result in zip(to_classify, chunk_results):
+        store_result(results, i, result)
+
+async def classify_file(input_file, output_file, chunksize):
+    """
+    Read, classify and write the CSV chunk by chunk in a single event loop, so every
+    chunk shares one client, one concurrency limit and one RPM/TPM budget
+    
+    Returns:
+        tuple: Counter of classifications (-1 for errors) and the number of rows written
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    
+    counts = Counter()
+    total_rows = 0
+    async with new_async_client() as client:
+        for chunk_num, dataset in enumerate(pd.read_csv(input_file, chunksize=chunksize), start=1):
+            # Check if the report column exists
+            if "report" not in dataset.columns:
+                raise ValueError("Error: 'report' column not found in the dataframe")
             
-            # Skip empty reports
-            if pd.isna(report_text) or report_text == "":
-                dataset.loc[i, 'liver_met_classification'] = 2  # Not sure
-                dataset.loc[i, 'liver_met_explanation'] = "No report text available"
-                dataset.loc[i, 'liver_lesion_count'] = None
-                continue
+            print(f"Processing chunk {chunk_num} (rows {total_rows + 1} to {total_rows + len(dataset)})...")
             
-            # Call the API to classify the report
-            print(f"  Classifying report {i + 1} of {total_rows}...")
-            result = classify_liver_metastasis(report_text)
+            # Results for classification, explanation, and lesion count, written to the chunk in bulk
+            results = new_result_arrays(len(dataset))
+            await classify_chunk(client, dataset, results, sem, limiter)
+            assign_results(dataset, results)
             
-            # Store the results
-            dataset.loc[i, 'liver_met_classification'] = result['classification']
-            dataset.loc[i, 'liver_met_explanation'] = result['explanation']
-            dataset.loc[i, 'liver_lesion_count'] = result['lesion_count']
+            # The first chunk replaces any previous output, later chunks are appended
+            dataset.to_csv(output_file, mode="w" if chunk_num == 1 else "a", header=chunk_num == 1, index=False)
+            print(f"Progress saved to {output_file}")
             
-            # Add a small delay to avoid hitting rate limits
-            time.sleep(0.5)
-        
-        # Save the progress after each batch
-        dataset.to_csv(output_file, index=False)
-        print(f"Progress saved to {output_file}")
+            for value, count in dataset['liver_met_classification'].value_counts(dropna=False).items():
+                counts[-1 if pd.isna(value) else int(value)] += count
+            total_rows += len(dataset)
+    
+    return counts, total_rows
+
+def process_liver_metastasis(input_file, output_file, chunksize=1000, use_batch_api=False):
+    """
+    Main function to stream a CSV of reports through the liver metastasis classification.
+    Only one chunk of rows is held in memory at a time.
+    
+    Args:
+        input_file (str): Path to the input CSV file with a 'report' column
+        output_file (str): Path to the output CSV file
+        chunksize (int): Number of reports to read, classify and write at a time
+        use_batch_api (bool): Submit all reports as one OpenAI Batch API job instead of realtime requests
         
-        # If not the last batch, add a longer delay between batches
-        if batch_num < num_batches:
-            print("Waiting 5 seconds before the next batch...")
-            time.sleep(5)
+    Returns:
+        pandas.DataFrame: Classification summary
+    """
+    if use_batch_api:
+        # Offline run: one Batch API job for the whole file up front. Only the report column is
+        # loaded; the results land in the response cache, so the streaming pass below reuses them
+        reports = pd.read_csv(input_file, usecols=['report'])
+        batch_input_file = os.path.splitext(output_file)[0] + "_batch_input.jsonl"
+        classify_with_batch_api(reports, batch_input_file)
+        del reports
+    
+    counts, total_rows = asyncio.run(classify_file(input_file, output_file, chunksize))
     
     # Generate summary statistics
-    summary = dataset['liver_met_classification'].value_counts().reset_index()
-    summary.columns = ['liver_met_classification', 'count']
+    summary = pd.DataFrame({
+        'liver_met_classification': pd.array([None if value < 0 else value for value in counts], dtype="Int8"),
+        'count': list(counts.values())
+    }).sort_values('count', ascending=False, ignore_index=True)
     
     # Add labels and percentages
     summary['label'] = summary['liver_met_classification'].map({
@@ -178,11 +308,9 @@ def process_liver_metastasis(df, output_file,  batch_size=10):
     print("\nClassification Summary:")
     print(summary)
     
-    # Save the final results
-    dataset.to_csv(output_file, index=False)
-    print(f"\nProcessing complete. Results saved to {output_file}")
+    print(f"\nProcessing complete. {total_rows} results saved to {output_file}")
     
-    return dataset
+    return summary
 
 # Main execution
 if __name__ == "__main__":
@@ -191,18 +319,15 @@ if __name__ == "__main__":
     
     if not api_key:
         api_key = input("Please enter your OpenAI API key: ")
+        os.environ["OPENAI_API_KEY"] = api_key  # Picked up by the shared clients
     
     # Load the data
     input_file = "data/liver_scans.csv"
     output_file = "data/liver_scans_results.csv"
     
     try:
-        # Read the CSV file
-        data = pd.read_csv(input_file)
-        print(f"Loaded {len(data)} records from {input_file}")
-        
         # Process the data
-        results = process_liver_metastasis(data, output_file)
+        summary = process_liver_metastasis(input_file, output_file, use_batch_api="--batch" in sys.argv)
         
     except Exception as e:
         print(f"Error: {str(e)}")
\ No newline at end of file
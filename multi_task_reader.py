@@ -0,0 +1,180 @@
+import json
+import asyncio
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from cxr_criteria import CXR_CRITERIA, CLASSIFICATION_COLUMN, prefilter_classification
+from liver_scans_reader import (RESPONSE_FORMAT as LIVER_RESPONSE_FORMAT, MODEL, MAX_CONCURRENT_REQUESTS,
+                                new_result_arrays, store_result, assign_results)
+from rate_limiter import RateLimiter, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, call_openai
+from response_cache import cache, cache_key
+from clients import new_async_client
+
+logger = logging.getLogger()
+
+# One prompt covering both tasks, so each report costs a single request and a single prompt prefix
+SYSTEM_PROMPT = ("You are a senior radiologist specialized in cancer mets detection. For each radiology report, fill in both fields of the JSON response.\n\n"
+                 "cxr_label: if this is a chest X-ray report, classify it to one of the following categories, otherwise null:\n"
+                 + CXR_CRITERIA
+                 + "\nliver_met: if the report covers the liver, give classification 0 if there is no liver metastasis, 1 if there is liver metastasis and 2 if not sure, "
+                 "in explanation one short sentence on why this is your choice (e.g. The report does not mention liver lesions) "
+                 "and in lesion_count the number of liver lesions you identified, or null if you are not sure. Otherwise null.")
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "cxr_and_liver",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "cxr_label": {"type": ["integer", "null"], "enum": [0, 1, 2, None]},
+                "liver_met": {"anyOf": [LIVER_RESPONSE_FORMAT["json_schema"]["schema"], {"type": "null"}]}
+            },
+            "required": ["cxr_label", "liver_met"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def build_request_body(report):
+    """
+    Build the chat completion request that runs both classifications on one report
+    """
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Report: {report}"}
+        ],
+        "response_format": RESPONSE_FORMAT,
+        "temperature": 0,
+        "max_tokens": 120
+    }
+
+def is_valid_result(result):
+    """
+    True if a parsed response holds a 0/1/2/null CXR label and a complete liver result or null
+    """
+    if not isinstance(result, dict):
+        return False
+    cxr_label = result.get("cxr_label")
+    if cxr_label is not None and not (type(cxr_label) is int and cxr_label in (0, 1, 2)):
+        return False
+    liver = result.get("liver_met")
+    if liver is None:
+        return True
+    return (isinstance(liver, dict)
+            and type(liver.get("classification")) is int and liver["classification"] in (0, 1, 2)
+            and isinstance(liver.get("explanation"), str)
+            and (liver.get("lesion_count") is None or type(liver["lesion_count"]) is int))
+
+async def classify_multi(client, report, sem, limiter):
+    """
+    Classify a report for both CXR normality and liver metastasis with a single request.
+    The CXR label follows extractor.py's prefilter_classification where that rule applies;
+    reports it marks as normal boilerplate are not sent at all.
+    
+    Args:
+        client (openai.AsyncOpenAI): OpenAI client
+        report (str): The radiology report text
+        sem (asyncio.Semaphore): Bounds the number of requests in flight
+        limiter (RateLimiter): Shared requests/tokens per minute budget
+        
+    Returns:
+        dict: {"cxr_label": ..., "liver_met": {...}} with null for tasks that do not apply,
+              or None if the request failed or returned an invalid result
+    """
+    cxr_label = prefilter_classification(report)
+    if cxr_label == 0:
+        # The whole report is normal chest X-ray boilerplate, so there is no liver finding either
+        return {"cxr_label": 0, "liver_met": None}
+    
+    key = cache_key(MODEL, SYSTEM_PROMPT, report)
+    result = cache.get(key)
+    if result is None:
+        try:
+            response = await call_openai(client, build_request_body(report), sem, limiter)
+            result = json.loads(response.choices[0].message.content)
+        except Exception as e:
+            logger.error(f"Error classifying report: {str(e)}")
+            return None
+        
+        if not is_valid_result(result):
+            logger.error(f"Invalid result for report: {result}")
+            return None
+        cache[key] = result
+    
+    if cxr_label is not None:
+        result = {**result, "cxr_label": cxr_label}
+    return result
+
+async def classify_all(reports):
+    """
+    Run classify_multi over every report concurrently, returning results in input order
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    async with new_async_client() as client:
+        return await asyncio.gather(*[classify_multi(client, report, sem, limiter) for report in reports])
+
+def process_reports(df, output_file, report_column="report"):
+    """
+    Add the CXR classification and liver metastasis columns to a dataframe of reports in one pass.
+    The columns are added to df in place; failed or missing labels are left as NA.
+    
+    Args:
+        df (pandas.DataFrame): DataFrame containing radiology reports
+        output_file (str): Path to the output CSV file
+        report_column (str): Name of the column holding the report text
+        
+    Returns:
+        pandas.DataFrame: df with both sets of results
+    """
+    if report_column not in df.columns:
+        raise ValueError(f"Error: '{report_column}' column not found in the dataframe")
+    
+    # -1 marks a missing CXR label; the liver results use the same layout as liver_scans_reader
+    cxr_labels = np.full(len(df), -1, dtype=np.int8)
+    liver_results = new_result_arrays(len(df))
+    
+    reports = df[report_column]
+    has_text = (reports.notna() & (reports.astype(str).str.strip() != "")).to_numpy()
+    positions = np.flatnonzero(has_text)
+    
+    logger.info(f"Classifying {len(positions)} of {len(df)} reports...")
+    results = asyncio.run(classify_all(reports.iloc[positions].tolist()))
+    
+    for i in np.flatnonzero(~has_text):
+        cxr_labels[i] = 2  # Mark empty reports as uncertain
+        store_result(liver_results, i, {"classification": 2, "explanation": "No report text available", "lesion_count": None})
+    for i, result in zip(positions, results):
+        if result is None:
+            cxr_labels[i] = 2  # Default to uncertain
+            store_result(liver_results, i, {"classification": "API Error", "explanation": "API Error: request failed", "lesion_count": None})
+            continue
+        if result["cxr_label"] is not None:
+            cxr_labels[i] = result["cxr_label"]
+        if result["liver_met"] is not None:
+            store_result(liver_results, i, result["liver_met"])
+    
+    df[CLASSIFICATION_COLUMN] = pd.arrays.IntegerArray(cxr_labels, mask=cxr_labels < 0)
+    assign_results(df, liver_results)
+    
+    df.to_csv(output_file, index=False)
+    logger.info(f"Results saved to {output_file}")
+    return df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the CXR and liver metastasis classifiers in a single request per report")
+    parser.add_argument("input_file", help="CSV or Parquet file of reports")
+    parser.add_argument("output_file", help="CSV file to write the results to")
+    parser.add_argument("--report-column", default="report", help="Column holding the report text")
+    args = parser.parse_args()
+    
+    if args.input_file.endswith(".parquet"):
+        data = pd.read_parquet(args.input_file)
+    else:
+        data = pd.read_csv(args.input_file)
+    process_reports(data, args.output_file, args.report_column)
@@ -0,0 +1,153 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from dotenv import load_dotenv
+from openai import RateLimitError, APIConnectionError, InternalServerError
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception, before_sleep_log
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Account rate limits (defaults match gpt-4o-mini on usage tier 1)
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "200000"))
+# Attempts per request before a transient API error (429, timeout, 5xx) is given up on
+MAX_API_ATTEMPTS = 6
+
+# Matches OpenAI reset durations such as "1s", "6m0s" or "20ms"
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_duration(value):
+    """
+    Convert an OpenAI rate-limit duration header ("1s", "6m0s", "20ms" or plain seconds) to seconds
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION_RE.findall(value or ""))
+
+def retry_after_seconds(headers, default=1.0):
+    """
+    How long to wait after a 429 response, taken from Retry-After or the rate-limit reset headers.
+    Without Retry-After the longer of the two resets is used, since either limit may be the one hit.
+    """
+    seconds = parse_duration(headers.get("retry-after"))
+    if seconds > 0:
+        return seconds
+    seconds = max(parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"))
+    return seconds if seconds > 0 else default
+
+class TokenBucket:
+    """
+    Holds up to `per_minute` units, refilled continuously at per_minute / 60 units per second
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = per_minute
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount):
+        """
+        Seconds until `amount` units are available (0 if they already are)
+        """
+        self.refill()
+        return max(0.0, (amount - self.available) / self.rate)
+
+class RateLimiter:
+    """
+    Paces API requests against requests-per-minute and tokens-per-minute budgets.
+    Requests only wait when a bucket is empty or the API has asked us to back off.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, estimated_tokens):
+        """
+        Wait until one request and `estimated_tokens` tokens are available, then take them
+        """
+        estimated_tokens = min(estimated_tokens, self.tokens.capacity)
+        async with self._lock:
+            while True:
+                delay = max(self.paused_until - time.monotonic(),
+                            self.requests.wait_time(1),
+                            self.tokens.wait_time(estimated_tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.available -= 1
+            self.tokens.available -= estimated_tokens
+    
+    def pause(self, seconds):
+        """
+        Hold back every request for `seconds`, e.g. after a 429 response
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def update_from_headers(self, headers):
+        """
+        Lower the buckets to the remaining budget the API reports, if it is below our estimate
+        """
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self.requests.refill()
+            self.requests.available = min(self.requests.available, float(remaining_requests))
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self.tokens.refill()
+            self.tokens.available = min(self.tokens.available, float(remaining_tokens))
+
+def estimate_tokens(body):
+    """
+    Rough token count of a request (about 4 characters per token plus the output budget)
+    """
+    prompt_chars = sum(len(message["content"]) for message in body["messages"])
+    return prompt_chars // 4 + body["max_tokens"]
+
+def is_transient_error(e):
+    """
+    True for API errors worth retrying: rate limits, timeouts, connection errors and 5xx.
+    An exhausted quota is also reported as a 429 but does not clear up by waiting.
+    """
+    if isinstance(e, RateLimitError):
+        return e.code != "insufficient_quota"
+    return isinstance(e, (APIConnectionError, InternalServerError))
+
+@retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(MAX_API_ATTEMPTS),
+    retry=retry_if_exception(is_transient_error),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True
+)
+async def call_openai(client, body, sem, limiter):
+    """
+    Send a chat completion once the rate limiter has budget for it.
+    Rate limits, timeouts, connection errors and 5xx responses are retried with exponential
+    backoff and jitter; other errors (e.g. authentication, invalid request, insufficient quota)
+    are raised immediately.
+    On a 429 response every request is also paused for as long as the API asks.
+    """
+    await limiter.acquire(estimate_tokens(body))
+    try:
+        async with sem:
+            raw_response = await client.chat.completions.with_raw_response.create(**body)
+    except RateLimitError as e:
+        if is_transient_error(e):
+            limiter.pause(retry_after_seconds(e.response.headers))
+        raise
+    limiter.update_from_headers(raw_response.headers)
+    return raw_response.parse()
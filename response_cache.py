@@ -0,0 +1,12 @@
+import hashlib
+import diskcache
+
+# Disk-backed store of model responses shared by all classifiers, so re-runs and
+# duplicate reports never hit the API twice
+cache = diskcache.Cache(".llm_cache")
+
+def cache_key(model, system_prompt, report_text):
+    """
+    Build the cache key for a report classified with a given model and system prompt
+    """
+    return hashlib.sha256((model + system_prompt + report_text).encode("utf-8")).hexdigest()
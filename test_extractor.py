@@ -1,9 +1,16 @@
 import os
+import asyncio
+import tempfile
 import pandas as pd
 import time
 import logging
-from openai import OpenAI
+from types import SimpleNamespace
 from dotenv import load_dotenv
+import extractor
+from extractor import build_request_body, classify_report, prefilter_classification, classify_packed_reports_async, load_checkpoint
+from liver_scans_reader import parse_liver_response
+from rate_limiter import RateLimiter, parse_duration, retry_after_seconds
+from clients import get_client
 
 # Load environment variables
 load_dotenv()
@@ -12,8 +19,8 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Shared OpenAI client
+client = get_client()
 
 def test_classification_direct():
     """
@@ -35,43 +42,15 @@ def test_classification_direct():
             print(f"REPORT {idx + 1}:")
             print(report_text[:200] + "..." if len(report_text) > 200 else report_text)
             
-            # Classify directly using the API
-            prompt = """You are a senior radiologist. Please classify this chest X-ray report to one of the following categories:
-            - 0 if you are sure it is normal
-            - 1 if you are sure it is abnormal
-            - 2 if you are not sure OR if the CXR has a line, catheter, or tube mentioned
-            
-            Comparison to previous CXR is not sufficient for classification unless it clearly states there are abnormalities or normality.
-            Respond with ONLY the number (0, 1, or 2) representing your classification.
-            
-            Report: """ + report_text
-            
+            # Classify directly using the API with the same request as extractor.py
             print("\nClassifying report...")
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a senior radiologist who classifies chest X-ray reports."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2,
-                max_tokens=10
-            )
+            response = client.chat.completions.create(**build_request_body(report_text))
             
             result = response.choices[0].message.content.strip()
             print(f"Raw API response: '{result}'")
             
-            # Process the result
-            if result in ["0", "1", "2"]:
-                classification = int(result)
-            elif any(digit in result for digit in ["0", "1", "2"]):
-                for digit in ["0", "1", "2"]:
-                    if digit in result:
-                        classification = int(digit)
-                        print(f"Extracted {digit} from response")
-                        break
-            else:
-                classification = 2  # Default to uncertain
-                print("Invalid response, defaulting to 2")
+            # The logit bias guarantees a single "0", "1" or "2" token
+            classification = int(result)
             
             print(f"\nCLASSIFICATION: {classification}")
             print("0: Normal, 1: Abnormal, 2: Uncertain/Has lines, catheters, tubes")
@@ -88,8 +67,6 @@ def test_from_extractor():
     """
     Test using the main script's classify_report function
     """
-    from extractor import classify_report
-    
     print("Starting test classification using main function...")
     
     try:
@@ -115,8 +92,120 @@ def test_from_extractor():
     except Exception as e:
         print(f"Error during test: {str(e)}")
 
+def test_prefilter_classification():
+    """
+    Test that the regex gate only short-circuits unambiguous reports
+    """
+    # Reports that mention a finding must be left to the model
+    for report_text in [
+        "Normal chest radiograph. Heart is enlarged.",
+        "Clear lungs. Widened mediastinum.",
+        "Clear lungs. Free air under the diaphragm.",
+        "No acute findings. Lytic lesion in the humerus.",
+        "No acute cardiopulmonary abnormality. Emphysema. Right upper lobe granuloma.",
+    ]:
+        assert prefilter_classification(report_text) is None, report_text
+
+    assert prefilter_classification("Normal chest radiograph.") == 0
+    assert prefilter_classification("IMPRESSION:  No acute cardiopulmonary abnormality.\n") == 0
+    assert prefilter_classification("Right PICC line tip in the SVC. Lungs are clear.") == 2
+
+class StubCompletions:
+    """
+    Stands in for client.chat.completions.with_raw_response, answering each request with
+    the content mapped to the first key found in its user message
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.bodies = []
+    
+    async def create(self, **body):
+        self.bodies.append(body)
+        user_message = body["messages"][-1]["content"]
+        content = next(value for key, value in self.responses.items() if key in user_message)
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(headers={}, parse=lambda: SimpleNamespace(choices=[SimpleNamespace(message=message)]))
+
+def classify_packed_with_stub(responses, report_texts):
+    """
+    Run classify_packed_reports_async against a stub client, keeping the results out of the response cache
+    """
+    completions = StubCompletions(responses)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(with_raw_response=completions)))
+    
+    async def classify():
+        limiter = RateLimiter(1000, 1000000)
+        return await classify_packed_reports_async(client, report_texts, asyncio.Semaphore(5), limiter)
+    
+    cache = extractor.cache
+    extractor.cache = {}
+    try:
+        return asyncio.run(classify()), completions.bodies
+    finally:
+        extractor.cache = cache
+
+def test_packed_fallback():
+    """
+    Test that invalid packed responses fall back to one single-token request per report
+    """
+    reports = ["Heart is enlarged.", "Small left effusion."]
+    
+    # A valid packed response is used as is
+    results, bodies = classify_packed_with_stub({"Reports:": '{"classifications": [1, 2]}'}, reports)
+    assert results == [1, 2] and len(bodies) == 1
+    
+    # Booleans, wrong counts and broken JSON are re-sent one report at a time
+    for packed in ['{"classifications": [1, true]}', '{"classifications": [1]}', '{"classifications": [1, ']:
+        results, bodies = classify_packed_with_stub(
+            {"Reports:": packed, "Heart is enlarged.": "1", "Small left effusion.": "0"}, reports)
+        assert results == [1, 0], packed
+        assert [body["max_tokens"] for body in bodies[1:]] == [1, 1]
+    
+    # An empty single-report response (e.g. a refusal) only loses that report's label
+    results, _ = classify_packed_with_stub(
+        {"Reports:": "{}", "Heart is enlarged.": None, "Small left effusion.": "0"}, reports)
+    assert results == [None, 0]
+
+def test_load_checkpoint():
+    """
+    Test that a line cut off by an interrupted run is skipped
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "checkpoint.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('{"idx": 0, "label": 1}\n{"idx": 5, "label": 2}\n{"idx": 6, "la')
+        assert load_checkpoint(path) == {0: 1, 5: 2}
+        assert load_checkpoint(os.path.join(tmp, "missing.jsonl")) == {}
+
+def test_rate_limit_headers():
+    """
+    Test parsing of the rate-limit duration headers
+    """
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("20ms") == 0.02
+    assert parse_duration("1.5") == 1.5
+    assert retry_after_seconds({"x-ratelimit-reset-requests": "20ms", "x-ratelimit-reset-tokens": "6m0s"}) == 360
+    assert retry_after_seconds({}) == 1.0
+
+def test_parse_liver_response():
+    """
+    Test that a liver response cut off by max_tokens is reported as an API error
+    """
+    result = parse_liver_response('{"classification": 1, "explanation": "Multiple hypodense')
+    assert result["classification"] == "API Error"
+    assert result["lesion_count"] is None
+    
+    result = parse_liver_response('{"classification": 0, "explanation": "No liver lesions.", "lesion_count": null}')
+    assert result == {"classification": 0, "explanation": "No liver lesions.", "lesion_count": None}
+
 if __name__ == "__main__":
-    print("=== Testing Direct API Classification ===")
+    print("=== Testing Offline Logic ===")
+    for test in [test_prefilter_classification, test_packed_fallback, test_load_checkpoint,
+                 test_rate_limit_headers, test_parse_liver_response]:
+        test()
+        print(f"{test.__name__} passed")
+    
+    print("\n\n=== Testing Direct API Classification ===")
     test_classification_direct()
     
     print("\n\n=== Testing Classification Using Main Function ===")